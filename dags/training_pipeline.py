@@ -1,40 +1,12 @@
 from datetime import datetime, timedelta
 from airflow import DAG
-from airflow.providers.http.operators.http import SimpleHttpOperator
-from airflow.operators.python import PythonOperator
-import json
+from airflow.decorators import task
+from airflow.providers.http.hooks.http import HttpHook
+from airflow.sensors.base import PokeReturnValue
+import os
+import requests
 
-def analyze_training_response(**context):
-    """Analyze the training service response"""
-    ti = context['ti']
-    response_str = ti.xcom_pull(task_ids='call_training_service')
-    
-    # Parse JSON string response
-    try:
-        response = json.loads(response_str) if isinstance(response_str, str) else response_str
-    except json.JSONDecodeError as e:
-        print(f"Failed to parse response as JSON: {e}")
-        print(f"Raw response: {response_str}")
-        raise
-
-    print(f"Training service response: {response}")
-    
-    if response.get('status') == 'success':
-        metrics = response.get('metrics', {})
-        print(f"Training successful!")
-        print(f"Validation accuracy: {metrics.get('val_accuracy', 0):.4f}")
-        print(f"Model size: {response.get('tflite_size_mb', 0):.2f} MB")
-        print(f"MLflow run: {response.get('mlflow_run_id', 'unknown')}")
-        
-        # Echo back training config for verification
-        config = response.get('training_config', {})
-        print(f"Training config used: {config}")
-        
-        return "Training completed successfully"
-    else:
-        error = response.get('error', 'Unknown error')
-        print(f"Training failed: {error}")
-        raise Exception(f"Training failed: {error}")
+MLFLOW_TRACKING_URI = os.environ.get('MLFLOW_TRACKING_URI', 'http://mlflow:5000')
 
 dag = DAG(
     'http_training_pipeline',
@@ -51,12 +23,13 @@ dag = DAG(
 )
 
 # Prepare training payload with proper types
+@task
 def prepare_training_data(**context):
     """Prepare training parameters with proper types"""
     dag_run = context['dag_run']
     config = dag_run.conf or {}
-    
-    # Convert to proper types here instead of in template
+
+    # Convert to proper types here; the dict is passed to the next task as-is
     training_payload = {
         "epochs": int(config.get('epochs', 5)),
         "learning_rate": float(config.get('learning_rate', 0.001)),
@@ -64,31 +37,83 @@ def prepare_training_data(**context):
         "experiment_name": str(config.get('experiment_name', 'http_training')),
         "run_name": f"airflow_{dag_run.run_id}"
     }
-    
+
     print(f"Prepared training payload: {training_payload}")
     return training_payload
 
-prepare_task = PythonOperator(
-    task_id='prepare_training_data',
-    python_callable=prepare_training_data,
-    dag=dag,
-)
+# Make sure the MLflow experiment exists before training starts
+@task
+def ensure_experiment(**context):
+    """Create the MLflow experiment if it doesn't exist yet"""
+    config = context['dag_run'].conf or {}
+    experiment_name = str(config.get('experiment_name', 'http_training'))
 
-# Call training service
-train_model_task = SimpleHttpOperator(
-    task_id='call_training_service',
-    http_conn_id='training_service',
-    endpoint='/train',
-    method='POST',
-    headers={"Content-Type": "application/json"},
-    data="{{ ti.xcom_pull(task_ids='prepare_training_data') | tojson }}",
-    dag=dag,
-)
+    response = requests.post(
+        f"{MLFLOW_TRACKING_URI}/api/2.0/mlflow/experiments/create",
+        json={"name": experiment_name},
+        timeout=30,
+    )
+    # Only MLflow's own errors are JSON; proxy/HTML error pages fall through to
+    # raise_for_status so the real HTTP status surfaces
+    is_json = response.headers.get('Content-Type', '').startswith('application/json')
+    if response.ok:
+        print(f"Created MLflow experiment: {experiment_name}")
+    elif is_json and response.json().get('error_code') == 'RESOURCE_ALREADY_EXISTS':
+        print(f"MLflow experiment already exists: {experiment_name}")
+    else:
+        response.raise_for_status()
 
-analyze_task = PythonOperator(
-    task_id='analyze_results',
-    python_callable=analyze_training_response,
-    dag=dag,
-)
+# Download the dataset on the training service while the other prep tasks run
+@task
+def warm_dataset():
+    """Populate the training service dataset cache"""
+    response = HttpHook(method='POST', http_conn_id='training_service').run('/warmup')
+    print(f"Warmup response: {response.json()}")
+
+# Call training service (returns immediately with a job id)
+@task
+def call_training_service(payload):
+    """Submit the training job and return its id"""
+    response = HttpHook(method='POST', http_conn_id='training_service').run(
+        '/train', json=payload
+    )
+    job_id = response.json()['job_id']
+    print(f"Submitted training job: {job_id}")
+    return job_id
+
+# Poll training status; reschedule mode frees the worker slot between pokes
+@task.sensor(poke_interval=60, timeout=4 * 60 * 60, mode='reschedule')
+def wait_for_training(job_id):
+    """Wait until the training job has left the queued/running states"""
+    response = HttpHook(method='GET', http_conn_id='training_service').run(
+        f'/status/{job_id}'
+    ).json()
+    is_done = response['state'] in ('done', 'failed')
+    return PokeReturnValue(is_done=is_done, xcom_value=response.get('result'))
+
+@task
+def analyze_results(response):
+    """Analyze the training service response"""
+    print(f"Training service response: {response}")
+
+    if response.get('status') == 'success':
+        metrics = response.get('metrics', {})
+        print(f"Training successful!")
+        print(f"Validation accuracy: {metrics.get('val_accuracy', 0):.4f}")
+        print(f"Model size: {response.get('tflite_size_mb', 0):.2f} MB")
+        print(f"MLflow run: {response.get('mlflow_run_id', 'unknown')}")
+
+        # Echo back training config for verification
+        config = response.get('training_config', {})
+        print(f"Training config used: {config}")
+
+        return "Training completed successfully"
+    else:
+        error = response.get('error', 'Unknown error')
+        print(f"Training failed: {error}")
+        raise Exception(f"Training failed: {error}")
 
-prepare_task >> train_model_task >> analyze_task
\ No newline at end of file
+with dag:
+    job_id = call_training_service(prepare_training_data())
+    [ensure_experiment(), warm_dataset()] >> job_id
+    analyze_results(wait_for_training(job_id))
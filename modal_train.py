@@ -12,10 +12,13 @@ image = modal.Image.from_registry("ghcr.io/martinrajniak/bean-disease-classifica
 # Volume for dataset caching (so you don't re-download every time)
 dataset_volume = modal.Volume.from_name("bean-dataset-cache", create_if_missing=True)
 
+# Volume for trained models (downloaded by path instead of returned through the RPC result)
+models_volume = modal.Volume.from_name("bean-models", create_if_missing=True)
+
 @app.function(
     gpu="T4",  # Options: "T4", "A10G", "A100-40GB", "A100-80GB"
     image=image,
-    volumes={"/data": dataset_volume},
+    volumes={"/data": dataset_volume, "/models": models_volume},
     timeout=3600,  # 1 hour max
 )
 def train_model(
@@ -26,10 +29,11 @@ def train_model(
     initial_lr: float = 0.1,
     finetune_lr: float = 0.01,
 ):
-    """Train model on Modal GPU and return model files"""
+    """Train model on Modal GPU and return the models volume directory with model files"""
     import sys
     import os
-    import tempfile
+    import glob
+    import shutil
     from datetime import datetime
 
     # Set working directory and Python path
@@ -37,8 +41,19 @@ def train_model(
     # so we add /app/src to the path
     sys.path.insert(0, "/app/src")
 
-    # Cache dataset in volume
-    os.environ['TFDS_DATA_DIR'] = '/data/tensorflow_datasets'
+    # Read cached datasets from container-local disk instead of the network volume.
+    # Until the preprocessed dataset exists, it's written to the volume to persist it.
+    def local_copy(volume_dir, local_dir):
+        if os.path.exists(volume_dir) and not os.path.exists(local_dir):
+            shutil.copytree(volume_dir, local_dir)
+        return local_dir if os.path.exists(volume_dir) else volume_dir
+
+    if glob.glob("/data/preprocessed/beans_tensorflow_224-*.tfrecord"):
+        preprocessed_data_dir = local_copy("/data/preprocessed", "/tmp/preprocessed")
+    else:
+        # TFDS is only read when the preprocessed dataset isn't there yet
+        preprocessed_data_dir = "/data/preprocessed"
+        os.environ['TFDS_DATA_DIR'] = local_copy('/data/tensorflow_datasets', '/tmp/tfds')
 
     from config.training_config import TrainingConfig, BaseModel, Optimizer, DatasetSource
     from training.trainer import train_model_core
@@ -60,6 +75,9 @@ def train_model(
         initial_lr=initial_lr,
         finetune_lr=finetune_lr,
         batch_size=batch_size,
+        # No cache_dir: the preprocessed splits (<1GB) are cached in memory; the
+        # TFRecord on the volume already persists the decoded images
+        preprocessed_data_dir=preprocessed_data_dir,
         experiment_name="bean_disease_modal",
         run_name=f"modal_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
     )
@@ -69,17 +87,10 @@ def train_model(
     print(f"Epochs: {epochs_pretrain} + {epochs_finetune}")
     print("=" * 60)
 
-    # Train using same code as Colab
-    output_dir = tempfile.mkdtemp()
+    # Train using same code as Colab, saving models straight to the models volume
+    output_dir = f"/models/{config.run_name}"
     result = train_model_core(config, output_dir=output_dir)
 
-    # Read model files
-    with open(f"{output_dir}/bean_disease_model.keras", "rb") as f:
-        keras_model = f.read()
-
-    with open(f"{output_dir}/bean_disease_model.tflite", "rb") as f:
-        tflite_model = f.read()
-
     print("\n" + "=" * 60)
     print("✅ TRAINING COMPLETED!")
     print("=" * 60)
@@ -87,12 +98,12 @@ def train_model(
     print(f"TFLite Size:   {result['tflite_size_mb']:.2f} MB")
     print("=" * 60)
 
-    # Commit volume to save cached dataset
+    # Commit volumes to save cached dataset and trained models
     dataset_volume.commit()
+    models_volume.commit()
 
     return {
-        "keras_model": keras_model,
-        "tflite_model": tflite_model,
+        "models_dir": config.run_name,
         "metrics": result["metrics"],
         "config": config.to_dict(),
     }
@@ -128,18 +139,14 @@ def main(
     output_dir = Path("models") / f"modal_{base_model.lower()}_{timestamp}"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    keras_path = output_dir / "bean_disease_model.keras"
-    tflite_path = output_dir / "bean_disease_model.tflite"
-
-    with open(keras_path, "wb") as f:
-        f.write(result["keras_model"])
-
-    with open(tflite_path, "wb") as f:
-        f.write(result["tflite_model"])
-
+    # Stream model files from the models volume
     print(f"\n📦 Models saved to: {output_dir}")
-    print(f"   - {keras_path.name}")
-    print(f"   - {tflite_path.name}")
+    for entry in models_volume.listdir(result["models_dir"]):
+        local_path = output_dir / Path(entry.path).name
+        with open(local_path, "wb") as f:
+            for chunk in models_volume.read_file(entry.path):
+                f.write(chunk)
+        print(f"   - {local_path.name}")
     print(f"\n📊 Final Metrics:")
     for key, value in result["metrics"].items():
         print(f"   {key}: {value:.4f}")
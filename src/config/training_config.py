@@ -4,7 +4,7 @@ Training configuration management
 
 from enum import Enum, auto
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union
 
 
 class DatasetSource(Enum):
@@ -32,12 +32,22 @@ class TrainingConfig:
     base_model: BaseModel = BaseModel.XCEPTION
     optimizer: Optimizer = Optimizer.SGD
     preprocess_in_model: bool = False
+    augment_in_model: Optional[bool] = None  # None: on GPU without XLA only
+    mixed_precision: bool = True  # Only applied when a GPU is available
+    # XLA-compile the train step; "auto" (Keras default) uses XLA on GPU when
+    # the model supports it, True also forces it on CPU
+    jit_compile: Union[bool, str] = "auto"
+    steps_per_execution: int = 32  # Train steps per compiled call
+    tflite_int8: bool = True  # Also export a full-integer quantized TFLite model
+    tflite_int8_io: bool = False  # int8 input/output (mobile app expects float32)
 
     # Dataset settings
     dataset_source: DatasetSource = DatasetSource.TENSORFLOW
     train_size: int = 1034
     val_size: int = 133
     test_size: int = 128
+    cache_dir: Optional[str] = None  # Persist tf.data cache to disk (in memory if None)
+    preprocessed_data_dir: Optional[str] = None  # Store resized images as TFRecord
 
     # Training parameters
     batch_size: int = 16
@@ -56,6 +66,7 @@ class TrainingConfig:
 
     # Reproducibility
     random_seed: int = 42
+    deterministic: bool = False  # Deterministic kernels and tf.data order (slower)
 
     # MLflow settings
     experiment_name: str = "bean_disease_classification"
@@ -75,4 +86,8 @@ class TrainingConfig:
             "finetune_lr": self.finetune_lr,
             "dropout_rate": self.dropout_rate,
             "random_seed": self.random_seed,
+            "deterministic": self.deterministic,
+            "mixed_precision": self.mixed_precision,
+            "jit_compile": self.jit_compile,
+            "steps_per_execution": self.steps_per_execution,
         }
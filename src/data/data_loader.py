@@ -5,7 +5,6 @@ Data loading and preprocessing for bean disease classification
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import numpy as np
-from sklearn.model_selection import train_test_split
 from typing import Tuple, List
 import collections
 
@@ -18,118 +17,229 @@ class BeanDataLoader:
         self.class_names = ["angular_leaf_spot", "bean_rust", "healthy"]
         self.n_classes = len(self.class_names)
 
+    def download(self):
+        """Download and prepare the dataset source, so the first load_data is fast"""
+        if self.config.dataset_source == DatasetSource.TENSORFLOW:
+            tfds.builder("beans").download_and_prepare()
+        elif self.config.dataset_source == DatasetSource.HUGGING_FACE:
+            from datasets import load_dataset
+
+            load_dataset("AI-Lab-Makerere/beans")
+
     def load_data(self) -> Tuple[tf.data.Dataset, tf.data.Dataset, tf.data.Dataset]:
         """Load and split the bean disease dataset"""
         print("Loading bean disease dataset...")
 
+        if self.config.preprocessed_data_dir:
+            images_array, labels_array = self._materialize_tfrecord(
+                f"{self.config.preprocessed_data_dir}/"
+                f"beans_{self.config.dataset_source.name.lower()}_224"
+            )
+        else:
+            images_array, labels_array = self._load_source()
+
+        print(f"Total samples: {len(images_array)}")
+
+        # Stratified split using indices
+        train_idx, val_idx, test_idx = self._stratified_indices(
+            labels_array,
+            sizes=(self.config.train_size, self.config.val_size),
+            seed=self.config.random_seed,
+        )
+
+        # Build datasets from a dense uint8 array so the pipeline stays in the
+        # TF runtime (no single-threaded Python generator between steps)
+        ds_train = tf.data.Dataset.from_tensor_slices(
+            (images_array[train_idx], labels_array[train_idx])
+        )
+        ds_valid = tf.data.Dataset.from_tensor_slices(
+            (images_array[val_idx], labels_array[val_idx])
+        )
+        ds_test = tf.data.Dataset.from_tensor_slices(
+            (images_array[test_idx], labels_array[test_idx])
+        )
+
+        print(f"Train: {len(train_idx)}, Val: {len(val_idx)}, Test: {len(test_idx)}")
+
+        # Verify class distribution
+        train_labels = labels_array[train_idx]
+        val_labels = labels_array[val_idx]
+        test_labels = labels_array[test_idx]
+
+        self._verify_class_distribution_from_labels(train_labels, "Training")
+        self._verify_class_distribution_from_labels(val_labels, "Validation")
+        self._verify_class_distribution_from_labels(test_labels, "Test")
+
+        return ds_train, ds_valid, ds_test
+
+    def _stratified_indices(
+        self, labels: np.ndarray, sizes: Tuple[int, ...], seed: int
+    ) -> List[np.ndarray]:
+        """Split indices into stratified parts, the last one taking the remainder"""
+        rng = np.random.default_rng(seed)
+        groups = [
+            rng.permutation(np.flatnonzero(labels == c)) for c in range(self.n_classes)
+        ]
+        remaining = np.array([len(group) for group in groups])
+        if sum(sizes) > remaining.sum():
+            raise ValueError(f"Split sizes {sizes} exceed {remaining.sum()} samples")
+
+        offsets = np.zeros(self.n_classes, dtype=np.int64)
+        splits = []
+        for size in sizes:
+            if remaining.sum() == 0:
+                # Earlier splits used every sample (size is 0, checked above)
+                counts = np.zeros(self.n_classes, dtype=np.int64)
+            else:
+                # Per-class quotas proportional to what is left, rounded with the
+                # largest remainder method so they add up to exactly `size`
+                quotas = size * remaining / remaining.sum()
+                counts = np.floor(quotas).astype(np.int64)
+                shortfall = size - counts.sum()
+                counts[np.argsort(counts - quotas)[:shortfall]] += 1
+
+            splits.append(
+                np.concatenate(
+                    [group[o : o + n] for group, o, n in zip(groups, offsets, counts)]
+                )
+            )
+            offsets += counts
+            remaining -= counts
+
+        splits.append(np.concatenate([group[o:] for group, o in zip(groups, offsets)]))
+        return [rng.permutation(split) for split in splits]
+
+    def _load_source(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Load the dataset from its source as 224x224 uint8 images and labels"""
         if self.config.dataset_source == DatasetSource.TENSORFLOW:
             # Load dataset directly without converting to dataframe
+            # Pin the interleave cycle length (the TFDS default, 16): it decides
+            # the record order, which must not depend on the machine for the
+            # seeded split to match. Parallel shard reads and decoding are
+            # already TFDS defaults.
+            read_config = tfds.ReadConfig(interleave_cycle_length=16)
             ds, info = tfds.load(
                 "beans",
                 split="all",
                 with_info=True,
                 shuffle_files=False,  # We'll shuffle after splitting
+                read_config=read_config,
                 as_supervised=True,
             )
 
             # Convert to lists for splitting (indices only)
+            # Materialize in batches so JPEG decoding runs on TF's threadpool
+            # instead of one eager round-trip per sample (beans images are 500x500)
+            ds_batched = ds.batch(256).prefetch(tf.data.AUTOTUNE)
             images_list = []
             labels_list = []
 
-            for image, label in ds:
-                images_list.append(image.numpy())
-                labels_list.append(label.numpy())
+            for images_batch, labels_batch in tfds.as_numpy(ds_batched):
+                images_list.extend(images_batch)
+                labels_list.append(labels_batch)
 
-            labels_array = np.array(labels_list)
+            labels_array = np.concatenate(labels_list)
 
         elif self.config.dataset_source == DatasetSource.HUGGING_FACE:
             from datasets import load_dataset, concatenate_datasets
-            import io
-            from PIL import Image
 
             ds = load_dataset("AI-Lab-Makerere/beans")
             ds_all = concatenate_datasets([ds["train"], ds["validation"], ds["test"]])
 
-            # Convert PIL images to numpy arrays
-            images_list = []
-            labels_list = []
+            # Decode PIL images to numpy arrays column-wise through the Arrow
+            # formatter instead of iterating over rows in Python
+            ds_all = ds_all.with_format("numpy", columns=["image", "labels"])
+            images_list = list(ds_all["image"])
+            labels_array = np.asarray(ds_all["labels"], dtype=np.int64)
 
-            for item in ds_all:
-                # Convert PIL Image to numpy array
-                img = item["image"]
-                if isinstance(img, Image.Image):
-                    img_array = np.array(img)
-                else:
-                    img_array = img
-                images_list.append(img_array)
-                labels_list.append(item["labels"])
+        return self._to_dense_images(images_list), labels_array
 
-            labels_array = np.array(labels_list)
+    def _materialize_tfrecord(self, prefix: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Load resized images and labels from TFRecord shards, writing the shards
+        first if they don't exist yet (so later runs skip decoding)
+        """
+        paths = sorted(tf.io.gfile.glob(f"{prefix}-*-of-*.tfrecord"))
+        if paths and len(paths) == int(paths[0].split("-of-")[1].split(".")[0]):
+            print(f"Using preprocessed dataset: {prefix} ({len(paths)} shards)")
+            return self._load_tfrecord(paths)
 
-        print(f"Total samples: {len(images_list)}")
+        images_array, labels_array = self._load_source()
 
-        # Stratified split using indices
-        indices = np.arange(len(images_list))
-        train_idx, temp_idx = train_test_split(
-            indices,
-            train_size=self.config.train_size,
-            random_state=self.config.random_seed,
-            shuffle=True,
-            stratify=labels_array,
-        )
+        # ~100MB shards, so reads can run in parallel; samples are strided across
+        # shards so reading them back round-robin restores the source order
+        num_shards = max(1, round(images_array.nbytes / (100 * 1024 * 1024)))
+        paths = [
+            f"{prefix}-{shard:05d}-of-{num_shards:05d}.tfrecord"
+            for shard in range(num_shards)
+        ]
 
-        val_idx, test_idx = train_test_split(
-            temp_idx,
-            train_size=self.config.val_size,
-            random_state=self.config.random_seed,
-            shuffle=True,
-            stratify=labels_array[temp_idx],
-        )
+        print(f"Writing preprocessed dataset: {prefix} ({num_shards} shards)")
+        tf.io.gfile.makedirs(self.config.preprocessed_data_dir)
+        for shard, path in enumerate(paths):
+            tmp_path = f"{path}.tmp"
+            with tf.io.TFRecordWriter(tmp_path) as writer:
+                for image, label in zip(
+                    images_array[shard::num_shards], labels_array[shard::num_shards]
+                ):
+                    example = tf.train.Example(
+                        features=tf.train.Features(
+                            feature={
+                                "image": tf.train.Feature(
+                                    bytes_list=tf.train.BytesList(
+                                        value=[tf.io.serialize_tensor(image).numpy()]
+                                    )
+                                ),
+                                "label": tf.train.Feature(
+                                    int64_list=tf.train.Int64List(value=[int(label)])
+                                ),
+                            }
+                        )
+                    )
+                    writer.write(example.SerializeToString())
 
-        # Create datasets using generator to avoid loading all into memory at once
-        def make_generator(indices):
-            def gen():
-                for idx in indices:
-                    yield images_list[idx], labels_array[idx]
-            return gen
-
-        # Create TensorFlow datasets from generators
-        ds_train = tf.data.Dataset.from_generator(
-            make_generator(train_idx),
-            output_signature=(
-                tf.TensorSpec(shape=(None, None, 3), dtype=tf.uint8),
-                tf.TensorSpec(shape=(), dtype=tf.int64),
-            )
-        )
+            # Rename when complete, so an interrupted run doesn't leave partial shards
+            tf.io.gfile.rename(tmp_path, path, overwrite=True)
 
-        ds_valid = tf.data.Dataset.from_generator(
-            make_generator(val_idx),
-            output_signature=(
-                tf.TensorSpec(shape=(None, None, 3), dtype=tf.uint8),
-                tf.TensorSpec(shape=(), dtype=tf.int64),
-            )
-        )
+        # Same arrays (in the same order) as reading the shards back
+        return images_array, labels_array
 
-        ds_test = tf.data.Dataset.from_generator(
-            make_generator(test_idx),
-            output_signature=(
-                tf.TensorSpec(shape=(None, None, 3), dtype=tf.uint8),
-                tf.TensorSpec(shape=(), dtype=tf.int64),
-            )
-        )
+    def _load_tfrecord(self, paths: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Read resized images and labels written by _materialize_tfrecord"""
+        feature_description = {
+            "image": tf.io.FixedLenFeature([], tf.string),
+            "label": tf.io.FixedLenFeature([], tf.int64),
+        }
 
-        print(f"Train: {len(train_idx)}, Val: {len(val_idx)}, Test: {len(test_idx)}")
+        def parse(record):
+            example = tf.io.parse_single_example(record, feature_description)
+            image = tf.io.parse_tensor(example["image"], out_type=tf.uint8)
+            image = tf.ensure_shape(image, (224, 224, 3))
+            return image, example["label"]
 
-        # Verify class distribution
-        train_labels = labels_array[train_idx]
-        val_labels = labels_array[val_idx]
-        test_labels = labels_array[test_idx]
+        # One reader per shard (not AUTOTUNE) and deterministic interleave/map keep
+        # the record order fixed across machines, so the seeded split is reproducible
+        ds = tf.data.TFRecordDataset(paths, num_parallel_reads=len(paths))
+        ds = ds.map(parse, num_parallel_calls=tf.data.AUTOTUNE).batch(256)
 
-        self._verify_class_distribution_from_labels(train_labels, "Training")
-        self._verify_class_distribution_from_labels(val_labels, "Validation")
-        self._verify_class_distribution_from_labels(test_labels, "Test")
+        images_batches = []
+        labels_batches = []
+        for images_batch, labels_batch in tfds.as_numpy(ds):
+            images_batches.append(images_batch)
+            labels_batches.append(labels_batch)
 
-        return ds_train, ds_valid, ds_test
+        return np.concatenate(images_batches), np.concatenate(labels_batches)
+
+    def _to_dense_images(
+        self, images_list: List[np.ndarray], batch_size: int = 256
+    ) -> np.ndarray:
+        """Resize images to 224x224 and stack them into one uint8 array"""
+        resized_batches = []
+        for start in range(0, len(images_list), batch_size):
+            batch = np.stack(images_list[start : start + batch_size])
+            resized = tf.image.resize_with_pad(batch, 224, 224)
+            resized_batches.append(tf.cast(tf.round(resized), tf.uint8).numpy())
+        return np.concatenate(resized_batches)
 
     def _verify_class_distribution(self, dataset: tf.data.Dataset, split_name: str):
         """Verify class distribution is maintained"""
@@ -143,7 +253,6 @@ class BeanDataLoader:
 
     def _verify_class_distribution_from_labels(self, labels: np.ndarray, split_name: str):
         """Verify class distribution from label array"""
-        label_counts = collections.Counter(labels)
-        total = len(labels)
-        ratios = {int(label): count / total for label, count in label_counts.items()}
+        counts = np.bincount(labels.astype(np.int64), minlength=self.n_classes)
+        ratios = dict(enumerate((counts / max(counts.sum(), 1)).tolist()))
         print(f"{split_name} class distribution: {ratios}")
@@ -2,6 +2,9 @@
 Model building utilities for bean disease classification
 """
 
+import functools
+
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.layers import (
@@ -20,81 +23,139 @@ from tensorflow.keras.models import Sequential, Model
 from config.training_config import TrainingConfig, BaseModel
 
 
+@functools.lru_cache(maxsize=4)
+def _get_preprocess_input(base_model: BaseModel):
+    """Resolve preprocess_input once per base model (shared across builders)"""
+    if base_model == BaseModel.XCEPTION:
+        from tensorflow.keras.applications.xception import preprocess_input
+    elif base_model == BaseModel.EFFICIENT_NET_V2:
+        from tensorflow.keras.applications.efficientnet_v2 import preprocess_input
+    elif base_model == BaseModel.MOBILE_NET:
+        from tensorflow.keras.applications.mobilenet import preprocess_input
+
+    return preprocess_input
+
+
 class BeanModelBuilder:
     def __init__(self, config: TrainingConfig):
         self.config = config
         self.n_classes = 3
+        self._finetune_boundary = None
 
-    def build_preprocessing_layers(self) -> Sequential:
-        """Build preprocessing and augmentation layers"""
-        if self.config.base_model == BaseModel.XCEPTION:
-            from tensorflow.keras.applications.xception import preprocess_input
-        elif self.config.base_model == BaseModel.EFFICIENT_NET_V2:
-            from tensorflow.keras.applications.efficientnet_v2 import preprocess_input
-        elif self.config.base_model == BaseModel.MOBILE_NET:
-            from tensorflow.keras.applications.mobilenet import preprocess_input
+        # Policy is global, so reset it explicitly when mixed precision is off
+        # (the API service builds models for several configs in one process)
+        if config.mixed_precision and tf.config.list_physical_devices("GPU"):
+            keras.mixed_precision.set_global_policy("mixed_float16")
+        else:
+            keras.mixed_precision.set_global_policy("float32")
 
-        # Base preprocessing
-        preprocess = Sequential(
-            [
-                Lambda(lambda x: tf.cast(x, tf.float32)),
-                Resizing(height=224, width=224, crop_to_aspect_ratio=True),
-                Lambda(preprocess_input),
-            ],
-            name="preprocessing",
-        )
+    def get_preprocess_input(self):
+        """Get the preprocess_input function matching the base model"""
+        return _get_preprocess_input(self.config.base_model)
 
-        # Augmentation layers
-        augmentation = Sequential(
+    def should_augment_in_model(self) -> bool:
+        """Whether augmentation runs in the model (on GPU) instead of in tf.data"""
+        if self.config.preprocess_in_model:
+            return True
+        if self.config.augment_in_model is None:
+            # RandomRotation doesn't support XLA, so in-model augmentation turns
+            # jit_compile off; only pick it when XLA isn't wanted anyway
+            return (
+                self.config.jit_compile is False
+                and bool(tf.config.list_physical_devices("GPU"))
+            )
+        return self.config.augment_in_model
+
+    def get_normalized_value_range(self):
+        """Pixel value range after preprocess_input ([-1, 1] for Xception)"""
+        low, high = self.get_preprocess_input()(np.array([0.0, 255.0], np.float32))
+        return float(low), float(high)
+
+    def build_augmentation(self, value_range=(0, 255), dtype=None) -> Sequential:
+        """
+        Build augmentation layers for images in the given value range.
+        dtype defaults to the global policy (for use in the model); pass "float32"
+        for tf.data, which runs on the CPU and should emit float32 batches.
+        """
+        seed = self.config.random_seed
+        return Sequential(
             [
-                RandomFlip(mode="horizontal", seed=self.config.random_seed),
-                RandomRotation(factor=0.05, seed=self.config.random_seed),
-                RandomContrast(factor=0.2, seed=self.config.random_seed),
+                RandomFlip(mode="horizontal", seed=seed, dtype=dtype),
+                RandomRotation(factor=0.05, seed=seed, dtype=dtype),
+                # RandomContrast clips to value_range, so it must match the input
+                RandomContrast(
+                    factor=0.2, value_range=value_range, seed=seed, dtype=dtype
+                ),
             ],
             name="augmentation",
         )
 
-        # Combined preprocessing and augmentation
-        preprocess_and_augmentation = Sequential(
+    def build_preprocessing_fn(self):
+        """Build resize + normalize function for tf.data (applied once, before caching)"""
+        preprocess_input = self.get_preprocess_input()
+
+        def preprocess(image, label):
+            image = tf.image.resize_with_pad(image, 224, 224)
+            image = tf.cast(image, tf.float32)
+            return preprocess_input(image), label
+
+        return preprocess
+
+    def build_preprocessing_layers(self):
+        """Build preprocessing and augmentation layers"""
+        preprocess_input = self.get_preprocess_input()
+
+        # Base preprocessing, shared by both compositions below
+        base_preprocess = Sequential(
             [
                 Lambda(lambda x: tf.cast(x, tf.float32)),
                 Resizing(height=224, width=224, crop_to_aspect_ratio=True),
-                RandomFlip(mode="horizontal", seed=self.config.random_seed),
-                RandomRotation(factor=0.05, seed=self.config.random_seed),
-                RandomContrast(factor=0.2, seed=self.config.random_seed),
-                Lambda(preprocess_input),
             ],
-            name="preprocess_and_augmentation",
+            name="preprocessing",
         )
+        normalize = Lambda(preprocess_input, name="normalization")
+
+        # Augmentation layers (the returned ones expect normalized images, as
+        # produced by build_preprocessing_fn; the composition augments pixels)
+        augmentation = self.build_augmentation(self.get_normalized_value_range())
+        pixel_augmentation = self.build_augmentation()
+
+        # Compose the same layer instances instead of building separate Sequentials
+        def preprocess(x):
+            return normalize(base_preprocess(x))
+
+        # Augment before normalization, on pixel values
+        def preprocess_and_augmentation(x):
+            return normalize(pixel_augmentation(base_preprocess(x)))
 
         return preprocess, augmentation, preprocess_and_augmentation
 
-    def build_base_model(self) -> keras.Model:
-        """Build the base model with pretrained weights"""
+    def build_base_model(self, weights="imagenet") -> keras.Model:
+        """Build the base model with pretrained weights (None skips loading them)"""
         if self.config.base_model == BaseModel.XCEPTION:
             from tensorflow.keras.applications.xception import Xception
 
             base_model = Xception(
-                input_shape=(224, 224, 3), include_top=False, weights="imagenet"
+                input_shape=(224, 224, 3), include_top=False, weights=weights
             )
         elif self.config.base_model == BaseModel.EFFICIENT_NET_V2:
             from tensorflow.keras.applications.efficientnet_v2 import EfficientNetV2S
 
             base_model = EfficientNetV2S(
-                input_shape=(224, 224, 3), include_top=False, weights="imagenet"
+                input_shape=(224, 224, 3), include_top=False, weights=weights
             )
         elif self.config.base_model == BaseModel.MOBILE_NET:
             from tensorflow.keras.applications.mobilenet import MobileNet
 
             base_model = MobileNet(
-                input_shape=(224, 224, 3), include_top=False, weights="imagenet"
+                input_shape=(224, 224, 3), include_top=False, weights=weights
             )
 
         return base_model
 
-    def build_model(self) -> keras.Model:
+    def build_model(self, weights="imagenet") -> keras.Model:
         """Build the complete model"""
-        base_model = self.build_base_model()
+        base_model = self.build_base_model(weights)
 
         if self.config.preprocess_in_model:
             _, _, preprocess_and_augmentation = self.build_preprocessing_layers()
@@ -102,6 +163,21 @@ class BeanModelBuilder:
             inputs = Input(shape=(None, None, 3))
             x = preprocess_and_augmentation(inputs)
             x = base_model(x, training=False)
+        elif self.should_augment_in_model():
+            # Inputs are already resized and normalized by tf.data (and cached);
+            # augmenting here keeps the random ops on the GPU next to the forward
+            # pass. The layers are a no-op at inference, so exported models still
+            # take the same normalized input.
+            if self.config.jit_compile is not False:
+                print(
+                    "Augmenting in the model: RandomRotation doesn't support XLA, "
+                    "so the train step runs with jit_compile=False"
+                )
+            augmentation = self.build_augmentation(self.get_normalized_value_range())
+
+            inputs = Input(shape=(224, 224, 3))
+            x = augmentation(inputs)
+            x = base_model(x)
         else:
             inputs = base_model.input
             x = base_model.output
@@ -109,7 +185,8 @@ class BeanModelBuilder:
         # Classification head
         x = GlobalAveragePooling2D()(x)
         x = Dropout(self.config.dropout_rate)(x)
-        outputs = Dense(self.n_classes, activation="softmax")(x)
+        # Keep softmax in float32 for numerically stable loss under mixed precision
+        outputs = Dense(self.n_classes, activation="softmax", dtype="float32")(x)
 
         model = Model(inputs=inputs, outputs=outputs, name="bean_disease_classifier")
 
@@ -122,6 +199,34 @@ class BeanModelBuilder:
 
         return model, base_model
 
+    def build_export_model(self, model: keras.Model) -> keras.Model:
+        """Float32 copy of a trained model, for SavedModel and TFLite export"""
+        if model.dtype_policy.name == "float32":
+            return model
+
+        # Under mixed_float16 convolutions and matmuls run in float16, which
+        # TFLite builtins don't accept; variables are float32 either way
+        policy = keras.mixed_precision.global_policy()
+        keras.mixed_precision.set_global_policy("float32")
+        try:
+            # Weights come from the trained model, so skip the pretrained load
+            export_model, _ = self.build_model(weights=None)
+        finally:
+            keras.mixed_precision.set_global_policy(policy)
+
+        export_model.set_weights(model.get_weights())
+        return export_model
+
+    def get_finetune_boundary(self, base_model: keras.Model) -> int:
+        """Index of the first Xception layer unfrozen for fine-tuning (start of block 7)"""
+        if self._finetune_boundary is None:
+            self._finetune_boundary = next(
+                i
+                for i, layer in enumerate(base_model.layers)
+                if layer.name == "block7_sepconv1_act"
+            )
+        return self._finetune_boundary
+
     def prepare_for_finetuning(self, model: keras.Model, base_model: keras.Model):
         """Prepare model for fine-tuning by unfreezing layers"""
         if self.config.preprocess_in_model:
@@ -131,10 +236,12 @@ class BeanModelBuilder:
                 for layer in base_model.layers[:-226]:
                     layer.trainable = False
         else:
-            # Unfreeze later layers for fine-tuning
+            # Unfreeze later layers for fine-tuning (only touch layers that change)
             if self.config.base_model == BaseModel.XCEPTION:
-                for layer in base_model.layers[56:]:
-                    layer.trainable = True
+                boundary = self.get_finetune_boundary(base_model)
+                for layer in base_model.layers[boundary:]:
+                    if not layer.trainable:
+                        layer.trainable = True
 
         print(
             f"Trainable layers: {sum(1 for layer in model.layers if layer.trainable)}"
@@ -1,8 +1,14 @@
 from flask import Flask, request, jsonify
+import queue
+import shutil
+import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from uuid import uuid4
 import mlflow
-import mlflow.tensorflow
 
 import sys
 import os
@@ -11,12 +17,97 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from config.training_config import TrainingConfig
-from training.trainer import train_model_core
+from data.data_loader import BeanDataLoader
+from training.trainer import train_model_core, load_datasets, data_settings_key
 
 app = Flask(__name__)
 
+# Finished jobs and uploads stay queryable this long, then are dropped so the
+# long-running service doesn't keep every result forever
+RESULT_TTL_S = 24 * 60 * 60
 
-def train_model_with_mlflow(config: TrainingConfig):
+
+class FutureRegistry:
+    """Futures by id; finished ones are evicted RESULT_TTL_S after completion"""
+
+    def __init__(self, ttl_s=RESULT_TTL_S):
+        self.ttl_s = ttl_s
+        self._futures = {}
+        self._finished_at = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, future):
+        with self._lock:
+            self._evict()
+            self._futures[key] = future
+        future.add_done_callback(lambda _: self._mark_finished(key))
+
+    def get(self, key):
+        with self._lock:
+            self._evict()
+            return self._futures.get(key)
+
+    def _mark_finished(self, key):
+        with self._lock:
+            self._finished_at[key] = time.monotonic()
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl_s
+        for key in [k for k, t in self._finished_at.items() if t < cutoff]:
+            del self._finished_at[key]
+            del self._futures[key]
+
+
+# Training runs in a background thread (one at a time, they share the GPU);
+# clients poll /status/<job_id> instead of holding the request open
+jobs = FutureRegistry()
+job_queue = queue.Queue()
+
+# Micro-batching: jobs queued together (e.g. a sweep) that share data settings
+# train back to back on one loaded and cached dataset
+MAX_BATCH_LATENCY_S = 0.5
+MAX_BATCH_SIZE = 8
+
+# Model artifacts upload in the background so the next job can start right
+# after metrics are logged; /artifact_status/<run_id> reports progress
+artifact_executor = ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="mlflow-upload"
+)
+artifact_uploads = FutureRegistry()
+
+
+def log_model_artifacts(run_id, model, tflite_model, tflite_int8_model):
+    """Upload the SavedModel and TFLite models to an MLflow run"""
+    artifacts_dir = tempfile.mkdtemp(prefix="bean_disease_model_")
+    try:
+        # The fluent API tracks the active run per thread, so resume it here
+        with mlflow.start_run(run_id=run_id):
+            print(f"Saving model to MLflow run {run_id}...")
+            # Inference-only SavedModel (no optimizer state), written by TF's
+            # native writer; load it with tf.saved_model.load
+            saved_model_dir = f"{artifacts_dir}/saved_model"
+            model.export(saved_model_dir)
+            mlflow.log_artifacts(saved_model_dir, "model")
+
+            # Save TFLite model to MLflow
+            tflite_path = f"{artifacts_dir}/bean_disease_model.tflite"
+            with open(tflite_path, "wb") as f:
+                f.write(tflite_model)
+            mlflow.log_artifact(tflite_path, "tflite_model")
+
+            # Save int8 TFLite model to MLflow for size/speed comparison
+            if tflite_int8_model is not None:
+                tflite_int8_path = f"{artifacts_dir}/bean_disease_model_int8.tflite"
+                with open(tflite_int8_path, "wb") as f:
+                    f.write(tflite_int8_model)
+                mlflow.log_artifact(tflite_int8_path, "tflite_model")
+
+        print(f"Model artifacts uploaded to MLflow run {run_id}")
+    finally:
+        shutil.rmtree(artifacts_dir, ignore_errors=True)
+
+
+def train_model_with_mlflow(config: TrainingConfig, datasets=None):
     """
     Wrapper that adds MLflow tracking to core training function.
     Used by the API service for experiment tracking.
@@ -31,27 +122,84 @@ def train_model_with_mlflow(config: TrainingConfig):
         mlflow.log_param("training_service", "production_api")
 
         # Run core training (without MLflow)
-        result = train_model_core(config)
+        result = train_model_core(config, datasets=datasets)
 
         # Log metrics to MLflow
         mlflow.log_metrics(result["metrics"])
-
-        # Save model to MLflow
-        print("Saving model to MLflow...")
-        mlflow.tensorflow.log_model(result["model"], "model")
-
-        # Save TFLite model to MLflow
-        tflite_path = "/tmp/bean_disease_model.tflite"
-        with open(tflite_path, "wb") as f:
-            f.write(result["tflite_model"])
-        mlflow.log_artifact(tflite_path, "tflite_model")
         mlflow.log_metric("tflite_size_mb", result["tflite_size_mb"])
+        if result["tflite_int8_model"] is not None:
+            mlflow.log_metric("tflite_int8_size_mb", result["tflite_int8_size_mb"])
 
         # Add MLflow run ID to result
         result["mlflow_run_id"] = mlflow.active_run().info.run_id
 
-        print(f"Training completed successfully with MLflow run: {result['mlflow_run_id']}")
-        return result
+    # Submit once the run is closed in this thread; the upload reopens it
+    artifact_uploads.add(
+        result["mlflow_run_id"],
+        artifact_executor.submit(
+            log_model_artifacts,
+            result["mlflow_run_id"],
+            result["export_model"],
+            result["tflite_model"],
+            result["tflite_int8_model"],
+        ),
+    )
+
+    print(f"Training completed successfully with MLflow run: {result['mlflow_run_id']}")
+    return result
+
+
+def run_training_job(config: TrainingConfig, datasets=None):
+    """Train in the background and keep only the JSON-serializable result"""
+    result = train_model_with_mlflow(config, datasets=datasets)
+
+    # Remove model objects from response (not JSON serializable), so finished
+    # jobs don't keep models alive in the job registry
+    return {
+        k: v
+        for k, v in result.items()
+        if k not in ["model", "export_model", "tflite_model", "tflite_int8_model"]
+    }
+
+
+def next_job_batch():
+    """Wait for a job, then collect more that arrive within MAX_BATCH_LATENCY_S"""
+    batch = [job_queue.get()]
+    deadline = time.monotonic() + MAX_BATCH_LATENCY_S
+    while len(batch) < MAX_BATCH_SIZE:
+        try:
+            batch.append(job_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            break
+    return batch
+
+
+def training_worker():
+    """Run queued jobs, loading data once per group of jobs with equal data settings"""
+    while True:
+        groups = {}
+        for future, config in next_job_batch():
+            groups.setdefault(data_settings_key(config), []).append((future, config))
+
+        for group in groups.values():
+            print(f"Training {len(group)} job(s) on a shared dataset")
+            try:
+                datasets = load_datasets(group[0][1])
+            except Exception as e:
+                for future, _ in group:
+                    future.set_running_or_notify_cancel()
+                    future.set_exception(e)
+                continue
+
+            for future, config in group:
+                future.set_running_or_notify_cancel()
+                try:
+                    future.set_result(run_training_job(config, datasets=datasets))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+threading.Thread(target=training_worker, daemon=True, name="training-worker").start()
 
 
 @app.route("/health", methods=["GET"])
@@ -59,6 +207,22 @@ def health_check():
     return jsonify({"status": "healthy", "service": "bean-disease-training-api"})
 
 
+@app.route("/warmup", methods=["POST"])
+def warmup():
+    try:
+        # Populate the dataset cache so training doesn't pay for the download
+        BeanDataLoader(TrainingConfig()).download()
+        return jsonify({"status": "success", "message": "Dataset cache is warm"})
+    except Exception as e:
+        error_result = {
+            "status": "error",
+            "error": str(e),
+            "traceback": traceback.format_exc(),
+        }
+        print(f"Warmup failed: {error_result}")
+        return jsonify(error_result), 500
+
+
 @app.route("/train", methods=["POST"])
 def train():
     try:
@@ -83,23 +247,63 @@ def train():
             random_seed=int(request_config.get("random_seed", 42)),
         )
 
-        print(f"Starting training with config: {config.to_dict()}")
+        job_id = str(uuid4())
+        print(f"Queueing training job {job_id} with config: {config.to_dict()}")
+        future = Future()
+        jobs.add(job_id, future)
+        job_queue.put((future, config))
 
-        result = train_model_with_mlflow(config)
-
-        # Remove model objects from response (not JSON serializable)
-        response = {k: v for k, v in result.items() if k not in ["model", "tflite_model"]}
-
-        return jsonify(response)
+        return jsonify({"status": "queued", "job_id": job_id}), 202
     except Exception as e:
         error_result = {
             "status": "error",
             "error": str(e),
             "traceback": traceback.format_exc(),
         }
-        print(f"Training failed: {error_result}")
+        print(f"Training request failed: {error_result}")
         return jsonify(error_result), 500
 
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+@app.route("/status/<job_id>", methods=["GET"])
+def status(job_id):
+    future = jobs.get(job_id)
+    if future is None:
+        return jsonify({"status": "error", "error": f"Unknown job: {job_id}"}), 404
+
+    if not future.done():
+        state = "running" if future.running() else "queued"
+        return jsonify({"job_id": job_id, "state": state})
+
+    error = future.exception()
+    if error is not None:
+        error_result = {
+            "status": "error",
+            "error": str(error),
+            "traceback": "".join(traceback.format_exception(error)),
+        }
+        return jsonify({"job_id": job_id, "state": "failed", "result": error_result})
+
+    return jsonify({"job_id": job_id, "state": "done", "result": future.result()})
+
+
+@app.route("/artifact_status/<run_id>", methods=["GET"])
+def artifact_status(run_id):
+    future = artifact_uploads.get(run_id)
+    if future is None:
+        return jsonify({"status": "error", "error": f"Unknown run: {run_id}"}), 404
+
+    if not future.done():
+        return jsonify({"mlflow_run_id": run_id, "state": "uploading"})
+
+    error = future.exception()
+    if error is not None:
+        error_result = {
+            "status": "error",
+            "error": str(error),
+            "traceback": "".join(traceback.format_exception(error)),
+        }
+        return jsonify(
+            {"mlflow_run_id": run_id, "state": "failed", "result": error_result}
+        )
+
+    return jsonify({"mlflow_run_id": run_id, "state": "done"})
@@ -0,0 +1,14 @@
+"""
+Gunicorn configuration for the training API service
+"""
+
+bind = "0.0.0.0:8000"
+
+# Single worker: training jobs and their status live in this process's memory
+# (see the job registry in api.py); threads keep /health and /status responsive
+workers = 1
+worker_class = "gthread"
+threads = 4
+
+# Long timeout for synchronous endpoints like /warmup (dataset download)
+timeout = 1800
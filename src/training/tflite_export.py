@@ -0,0 +1,78 @@
+"""
+TFLite conversion for bean disease classification models.
+
+Run as a script by the trainer (see export_tflite_models), so the converter's
+memory is released when the process exits instead of adding to the training
+process peak.
+"""
+
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def convert(saved_model_dir):
+    """Convert a SavedModel to float TFLite"""
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+
+    # Optimizations for mobile deployment
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float32]
+    converter.inference_input_type = tf.float32
+    converter.inference_output_type = tf.float32
+
+    # Builtin ops only, so the model runs without the Flex delegate; expects a
+    # float32 model (see BeanModelBuilder.build_export_model)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+
+    return converter.convert()
+
+
+def convert_int8(saved_model_dir, representative_images, int8_io=False):
+    """Convert a SavedModel to full-integer (int8) TFLite"""
+
+    def representative_dataset():
+        for image in representative_images:
+            yield [image[np.newaxis].astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    # By default quantize/dequantize at the edges so the mobile app keeps
+    # feeding floats; int8 I/O skips that for clients that quantize themselves
+    io_type = tf.int8 if int8_io else tf.float32
+    converter.inference_input_type = io_type
+    converter.inference_output_type = io_type
+
+    return converter.convert()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a SavedModel to TFLite")
+    parser.add_argument("saved_model_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument(
+        "--representative",
+        help="Calibration images (.npy); also writes the int8 model if given",
+    )
+    parser.add_argument("--int8-io", action="store_true")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.output_dir, "model.tflite"), "wb") as f:
+        f.write(convert(args.saved_model_dir))
+
+    if args.representative:
+        representative_images = np.load(args.representative)
+        tflite_int8_model = convert_int8(
+            args.saved_model_dir, representative_images, int8_io=args.int8_io
+        )
+        with open(os.path.join(args.output_dir, "model_int8.tflite"), "wb") as f:
+            f.write(tflite_int8_model)
+
+
+if __name__ == "__main__":
+    main()
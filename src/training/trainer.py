@@ -1,3 +1,17 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+# GPU runtime settings are read when TensorFlow initializes, so set them
+# before importing it (setdefault keeps values overridden in the environment)
+os.environ.setdefault("TF_CUDNN_USE_AUTOTUNE", "1")
+# Dedicated threads for launching GPU kernels, so input pipeline work on the
+# shared CPU pool doesn't delay them
+os.environ.setdefault("TF_GPU_THREAD_MODE", "gpu_private")
+os.environ.setdefault("TF_GPU_THREAD_COUNT", "2")
+
+import numpy as np
 import tensorflow as tf
 
 # Configure GPU memory growth BEFORE any TensorFlow operations
@@ -8,17 +22,48 @@ if gpus:
             tf.config.experimental.set_memory_growth(gpu, True)
     except RuntimeError as e:
         print(f"GPU setup warning: {e}")
-
-# Set up deterministic behavior AFTER GPU configuration
-tf.keras.utils.set_random_seed(42)
-
+    # TF32 tensor cores for float32 ops (Ampere+); mixed precision covers the rest
+    tf.config.experimental.enable_tensor_float_32_execution(True)
 
 from config.training_config import TrainingConfig, BaseModel, Optimizer
 from data.data_loader import BeanDataLoader
 from models.model_builder import BeanModelBuilder
 
+TFLITE_EXPORT_SCRIPT = os.path.join(os.path.dirname(__file__), "tflite_export.py")
+
+
+def load_datasets(config: TrainingConfig, model_builder=None):
+    """
+    Load, split, preprocess and cache the datasets for training.
+    The result can be shared by configs with the same data settings (see
+    data_settings_key); batch_datasets then adds each run's shuffle/augment/batch.
+    """
+    # Load data
+    print("Loading dataset...")
+    data_loader = BeanDataLoader(config)
+    ds_train, ds_valid, ds_test = data_loader.load_data()
+
+    # Prepare data pipeline
+    print("Preparing data pipeline...")
+    return cache_datasets(ds_train, ds_valid, ds_test, config, model_builder)
+
+
+def data_settings_key(config: TrainingConfig):
+    """Config fields that determine the output of load_datasets"""
+    return (
+        config.base_model,
+        config.preprocess_in_model,
+        config.dataset_source,
+        config.train_size,
+        config.val_size,
+        config.test_size,
+        config.random_seed,
+        config.cache_dir,
+        config.preprocessed_data_dir,
+    )
+
 
-def train_model_core(config: TrainingConfig, output_dir=None):
+def train_model_core(config: TrainingConfig, output_dir=None, datasets=None):
     """
     Core training function without MLflow dependency.
     Can be used standalone or wrapped with MLflow tracking.
@@ -26,29 +71,43 @@ def train_model_core(config: TrainingConfig, output_dir=None):
     Args:
         config: Training configuration
         output_dir: Optional directory to save models (if None, models not saved to disk)
+        datasets: Optional (ds_train, ds_valid, ds_test) from load_datasets, to reuse
+            already loaded data (if None, datasets are loaded for this config)
 
     Returns:
-        dict with training results including model, tflite_model, and metrics
+        dict with training results including model, export_model (float32 copy
+        for SavedModel/TFLite), tflite_model, and metrics
     """
-    # Load data
-    print("Loading dataset...")
-    data_loader = BeanDataLoader(config)
-    ds_train, ds_valid, ds_test = data_loader.load_data()
+    # Seed Python, NumPy and TF for this run; seeding alone keeps the fast
+    # (non-deterministic) cuDNN kernels, bit-exact runs are opt-in
+    tf.keras.utils.set_random_seed(config.random_seed)
+    if config.deterministic:
+        # Process-wide and can't be turned off again
+        tf.config.experimental.enable_op_determinism()
+
+    # One builder for both the data pipeline and the model
+    model_builder = BeanModelBuilder(config)
 
-    # Prepare data pipeline
-    print("Preparing data pipeline...")
-    ds_train, ds_valid, ds_test = prepare_data_pipeline(
-        ds_train, ds_valid, ds_test, config
-    )
+    if datasets is None:
+        datasets = load_datasets(config, model_builder)
+
+    # Fresh shuffle and augmentation state for every run, so a run on shared
+    # datasets sees the same data order as the same config run alone
+    ds_train, ds_valid, ds_test = batch_datasets(*datasets, config, model_builder)
 
     # Build model
     print("Building model...")
-    model_builder = BeanModelBuilder(config)
     model, base_model = model_builder.build_model()
 
     print("Model architecture:")
     model.summary()
 
+    # Never run more steps per call than an epoch has, so epoch-level callbacks
+    # (EarlyStopping, checkpoints) still see every epoch boundary
+    steps_per_execution = max(
+        1, min(config.steps_per_execution, config.train_size // config.batch_size)
+    )
+
     # Phase 1: Initial training
     print("Phase 1: Initial training (frozen base model)...")
     optimizer = get_optimizer(config, phase="pretrain")
@@ -56,15 +115,24 @@ def train_model_core(config: TrainingConfig, output_dir=None):
         loss="sparse_categorical_crossentropy",
         optimizer=optimizer,
         metrics=["accuracy"],
+        jit_compile=config.jit_compile,
+        steps_per_execution=steps_per_execution,
     )
 
+    if gpus and config.jit_compile is False:
+        # Pick cuDNN algorithms for the batch shape now, so the one-off cost
+        # isn't counted in the first epoch (Phase 2 reuses the same shapes).
+        # XLA autotunes its own compiled step, so this only helps without it;
+        # inference mode leaves the augmentation seed state untouched
+        model(tf.zeros((config.batch_size, 224, 224, 3)), training=False)
+
     callbacks = get_callbacks(config, phase="pretrain")
     history_pretrain = model.fit(
         ds_train,
         validation_data=ds_valid,
         epochs=config.epochs_pretrain,
         callbacks=callbacks,
-        verbose=1,
+        verbose=2,  # One line per epoch instead of a per-batch progress bar
     )
 
     # Phase 2: Fine-tuning
@@ -77,6 +145,8 @@ def train_model_core(config: TrainingConfig, output_dir=None):
             loss="sparse_categorical_crossentropy",
             optimizer=optimizer,
             metrics=["accuracy"],
+            jit_compile=config.jit_compile,
+            steps_per_execution=steps_per_execution,
         )
 
         callbacks = get_callbacks(config, phase="finetune")
@@ -85,7 +155,7 @@ def train_model_core(config: TrainingConfig, output_dir=None):
             validation_data=ds_valid,
             epochs=config.epochs_finetune,
             callbacks=callbacks,
-            verbose=1,
+            verbose=2,
         )
 
         # Combine histories
@@ -107,14 +177,25 @@ def train_model_core(config: TrainingConfig, output_dir=None):
         "test_loss": float(test_loss),
     }
 
-    # Convert to TFLite
+    # Export a float32 copy (the GPU policy trains in mixed_float16)
+    export_model = model_builder.build_export_model(model)
+
+    # Convert to TFLite; int8 is calibrated on validation images (preprocessed
+    # like inference inputs)
     print("Converting to TFLite...")
-    tflite_model = convert_to_tflite(model)
+    tflite_model, tflite_int8_model = export_tflite_models(
+        export_model,
+        ds_valid if config.tflite_int8 else None,
+        int8_io=config.tflite_int8_io,
+    )
     model_size_mb = len(tflite_model) / (1024 * 1024)
 
+    int8_size_mb = None
+    if tflite_int8_model is not None:
+        int8_size_mb = len(tflite_int8_model) / (1024 * 1024)
+
     # Save models to disk if output_dir is provided
     if output_dir:
-        import os
         os.makedirs(output_dir, exist_ok=True)
 
         # Save Keras model
@@ -128,12 +209,21 @@ def train_model_core(config: TrainingConfig, output_dir=None):
             f.write(tflite_model)
         print(f"TFLite model saved to: {tflite_path}")
 
+        if tflite_int8_model is not None:
+            tflite_int8_path = f"{output_dir}/bean_disease_model_int8.tflite"
+            with open(tflite_int8_path, "wb") as f:
+                f.write(tflite_int8_model)
+            print(f"Int8 TFLite model saved to: {tflite_int8_path}")
+
     result = {
         "status": "success",
         "model": model,
+        "export_model": export_model,
         "tflite_model": tflite_model,
         "metrics": final_metrics,
         "tflite_size_mb": model_size_mb,
+        "tflite_int8_model": tflite_int8_model,
+        "tflite_int8_size_mb": int8_size_mb,
         "training_config": config.to_dict(),
         "message": f"Training completed! Test accuracy: {test_accuracy:.4f}",
     }
@@ -142,50 +232,101 @@ def train_model_core(config: TrainingConfig, output_dir=None):
     print(f"  Test accuracy: {test_accuracy:.4f}")
     print(f"  Test loss: {test_loss:.4f}")
     print(f"  TFLite size: {model_size_mb:.2f} MB")
+    if int8_size_mb is not None:
+        print(f"  Int8 TFLite size: {int8_size_mb:.2f} MB")
 
     return result
 
 
-def prepare_data_pipeline(ds_train, ds_valid, ds_test, config):
-    """Prepare optimized data pipeline"""
-    model_builder = BeanModelBuilder(config)
-    preprocess, augmentation, _ = model_builder.build_preprocessing_layers()
+def prepare_data_pipeline(ds_train, ds_valid, ds_test, config, model_builder=None):
+    """Prepare optimized data pipeline (pass the model's builder to share it)"""
+    if model_builder is None:
+        model_builder = BeanModelBuilder(config)
+
+    datasets = cache_datasets(ds_train, ds_valid, ds_test, config, model_builder)
+    return batch_datasets(*datasets, config, model_builder)
+
+
+def cache_datasets(ds_train, ds_valid, ds_test, config, model_builder=None):
+    """Preprocess (unless done in the model) and cache the splits"""
+    if model_builder is None:
+        model_builder = BeanModelBuilder(config)
 
     if not config.preprocess_in_model:
-        # Apply preprocessing
-        ds_train = ds_train.map(
-            lambda x, y: (preprocess(x), y), num_parallel_calls=tf.data.AUTOTUNE
-        )
-        ds_valid = ds_valid.map(
-            lambda x, y: (preprocess(x), y), num_parallel_calls=tf.data.AUTOTUNE
-        )
-        ds_test = ds_test.map(
-            lambda x, y: (preprocess(x), y), num_parallel_calls=tf.data.AUTOTUNE
-        )
+        # Resize and normalize once, before caching, so later epochs only
+        # stream cached tensors
+        preprocess = model_builder.build_preprocessing_fn()
+        ds_train = ds_train.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+        ds_valid = ds_valid.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+        ds_test = ds_test.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+
+    return (
+        ds_train.cache(get_cache_path(config, "train")),
+        ds_valid.cache(get_cache_path(config, "valid")),
+        ds_test.cache(get_cache_path(config, "test")),
+    )
+
+
+def batch_datasets(ds_train, ds_valid, ds_test, config, model_builder=None):
+    """Shuffle, augment and batch cached splits (see cache_datasets) for one run"""
+    if model_builder is None:
+        model_builder = BeanModelBuilder(config)
 
     # Training pipeline with augmentation
-    ds_train = ds_train.cache()
-    ds_train = ds_train.shuffle(config.train_size)
-    if not config.preprocess_in_model:
+    ds_train = ds_train.shuffle(config.train_size, seed=config.random_seed)
+    # Drop the last partial batch (1034 % 16 = 10 samples), which would trace and
+    # XLA-compile a second train step for its shape; shuffling changes which
+    # samples are dropped every epoch
+    ds_train = ds_train.batch(
+        config.batch_size, drop_remainder=True, num_parallel_calls=tf.data.AUTOTUNE
+    )
+    if not model_builder.should_augment_in_model():
+        # float32 regardless of the mixed precision policy: float16 is slow on CPU
+        augmentation = model_builder.build_augmentation(
+            model_builder.get_normalized_value_range(), dtype="float32"
+        )
+        # Augment whole batches after caching so randomness varies per epoch;
+        # batch order is already random, so let finished batches pass first
+        # (unless the run must be reproducible)
         ds_train = ds_train.map(
-            lambda x, y: (augmentation(x), y), num_parallel_calls=tf.data.AUTOTUNE
+            lambda x, y: (augmentation(x), y),
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=config.deterministic,
         )
-    ds_train = ds_train.batch(config.batch_size)
     ds_train = ds_train.prefetch(tf.data.AUTOTUNE)
 
     # Validation pipeline
-    ds_valid = ds_valid.cache()
-    ds_valid = ds_valid.batch(config.batch_size)
+    ds_valid = ds_valid.batch(config.batch_size, num_parallel_calls=tf.data.AUTOTUNE)
     ds_valid = ds_valid.prefetch(tf.data.AUTOTUNE)
 
     # Test pipeline
-    ds_test = ds_test.cache()
-    ds_test = ds_test.batch(config.batch_size)
+    ds_test = ds_test.batch(config.batch_size, num_parallel_calls=tf.data.AUTOTUNE)
     ds_test = ds_test.prefetch(tf.data.AUTOTUNE)
 
     return ds_train, ds_valid, ds_test
 
 
+def get_cache_path(config, split):
+    """Get tf.data cache file for a split ("" keeps the cache in memory)"""
+    if not config.cache_dir:
+        return ""
+
+    # Cached elements are already preprocessed, so key them by everything
+    # that changes preprocessing or the split
+    cache_key = "_".join(
+        [
+            config.base_model.name.lower(),
+            "raw" if config.preprocess_in_model else "preprocessed",
+            config.dataset_source.name.lower(),
+            f"seed{config.random_seed}",
+            f"{config.train_size}-{config.val_size}-{config.test_size}",
+            split,
+        ]
+    )
+    tf.io.gfile.makedirs(config.cache_dir)
+    return f"{config.cache_dir}/{cache_key}"
+
+
 def get_optimizer(config, phase="pretrain"):
     """Get optimizer for training phase"""
     if config.optimizer == Optimizer.SGD:
@@ -215,20 +356,69 @@ def get_callbacks(config, phase="pretrain"):
     return callbacks
 
 
+def export_tflite_models(
+    model, ds_representative=None, num_samples=100, int8_io=False
+):
+    """
+    Convert Keras model to float TFLite, and to int8 TFLite if calibration
+    data is given. Returns (tflite_model, tflite_int8_model or None).
+
+    Conversion runs in a subprocess on the CPU, so the converter neither keeps
+    its memory in this process nor allocates GPU memory next to the model.
+    """
+    with tempfile.TemporaryDirectory(prefix="bean_disease_tflite_") as tmp_dir:
+        saved_model_dir = os.path.join(tmp_dir, "saved_model")
+        # Fixed single-image input (what the app feeds), so the converter
+        # specializes the graph instead of keeping a dynamic batch dimension
+        model.export(
+            saved_model_dir,
+            input_signature=[tf.TensorSpec((1, 224, 224, 3), tf.float32)],
+        )
+
+        command = [sys.executable, TFLITE_EXPORT_SCRIPT, saved_model_dir, tmp_dir]
+        if ds_representative is not None:
+            representative_path = os.path.join(tmp_dir, "representative.npy")
+            np.save(
+                representative_path,
+                np.stack(
+                    [
+                        image
+                        for image, _ in ds_representative.unbatch()
+                        .take(num_samples)
+                        .as_numpy_iterator()
+                    ]
+                ).astype(np.float32),
+            )
+            command += ["--representative", representative_path]
+            if int8_io:
+                command.append("--int8-io")
+
+        process = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            env={**os.environ, "CUDA_VISIBLE_DEVICES": "-1"},
+        )
+        if process.returncode != 0:
+            # Surface the converter's error (e.g. ops without a builtin kernel)
+            stderr_tail = "\n".join(process.stderr.strip().splitlines()[-20:])
+            raise RuntimeError(
+                f"TFLite conversion failed (exit code {process.returncode}):\n"
+                f"{stderr_tail}"
+            )
+
+        with open(os.path.join(tmp_dir, "model.tflite"), "rb") as f:
+            tflite_model = f.read()
+
+        tflite_int8_model = None
+        if ds_representative is not None:
+            with open(os.path.join(tmp_dir, "model_int8.tflite"), "rb") as f:
+                tflite_int8_model = f.read()
+
+    return tflite_model, tflite_int8_model
+
+
 def convert_to_tflite(model):
-    """Convert Keras model to TFLite"""
-    converter = tf.lite.TFLiteConverter.from_keras_model(model)
-
-    # Optimizations for mobile deployment
-    converter.optimizations = [tf.lite.Optimize.DEFAULT]
-    converter.target_spec.supported_types = [tf.float32]
-    converter.inference_input_type = tf.float32
-    converter.inference_output_type = tf.float32
-
-    # Enable Select TF Ops for complex models like Xception
-    converter.target_spec.supported_ops = [
-        tf.lite.OpsSet.TFLITE_BUILTINS,
-        tf.lite.OpsSet.SELECT_TF_OPS,
-    ]
-
-    return converter.convert()
+    """Convert Keras model to float TFLite (export_tflite_models also does int8)"""
+    tflite_model, _ = export_tflite_models(model)
+    return tflite_model